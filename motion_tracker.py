@@ -1,176 +1,85 @@
 import cv2
 import numpy as np
-import math
 import time
-from collections import deque
-
-TARGET_WIDTH_INCHES = 1.5
-
-KNOWN_QR_CODE_WIDTH_CM = TARGET_WIDTH_INCHES * 2.54
-MOVEMENT_THRESHOLD_MM = 2.5
-STILL_TIME_THRESHOLD = 1.0
-TARGET_QR_DATA = "MRI_HEAD_MOTION_TRACKER_V1.0"
-
-center_pixel = None
-is_center_set = False
-pixels_per_mm = None
-measurement_unit = 'mm'  # Default to millimeters
-
-position_history = deque(maxlen=100)  # Store recent positions with timestamps
-last_movement_time = None
-
-def calculate_displacement(current_center_pixel):
-    if not is_center_set or pixels_per_mm is None or pixels_per_mm == 0:
-        return 0, 0, 0
-
-    delta_x_pix = current_center_pixel[0] - center_pixel[0]
-    delta_y_pix = current_center_pixel[1] - center_pixel[1]
-    pixel_distance = math.sqrt(delta_x_pix**2 + delta_y_pix**2)
-
-    mm_distance = pixel_distance / pixels_per_mm
-    delta_x_mm = delta_x_pix / pixels_per_mm
-    delta_y_mm = delta_y_pix / pixels_per_mm
-
-    return mm_distance, delta_x_mm, delta_y_mm
-
-def update_position_history(current_center_pixel, current_time):
-    """Update position history for tracking stillness"""
-    global last_movement_time
-    
-    if len(position_history) == 0:
-        position_history.append((current_center_pixel, current_time))
-        last_movement_time = current_time
-        return
-    
-    recent_positions = [pos for pos, timestamp in position_history if current_time - timestamp <= 0.5]  # Last 0.5 seconds
-    
-    if recent_positions:
-        avg_x = sum(pos[0] for pos in recent_positions) / len(recent_positions)
-        avg_y = sum(pos[1] for pos in recent_positions) / len(recent_positions)
-        avg_position = (avg_x, avg_y)
-        
-        distance_pixels = math.sqrt((current_center_pixel[0] - avg_position[0])**2 + 
-                                  (current_center_pixel[1] - avg_position[1])**2)
-        
-        if pixels_per_mm and pixels_per_mm > 0:
-            distance_mm = distance_pixels / pixels_per_mm
-            
-            if distance_mm > MOVEMENT_THRESHOLD_MM:
-                last_movement_time = current_time
-    
-    position_history.append((current_center_pixel, current_time))
-    
-    while position_history and current_time - position_history[0][1] > 3.0:
-        position_history.popleft()
-
-def is_qr_still(current_time):
-    if last_movement_time is None:
-        return False
-    return (current_time - last_movement_time) >= STILL_TIME_THRESHOLD
-
-def is_qr_centered(total_distance_mm):
-    return total_distance_mm <= MOVEMENT_THRESHOLD_MM
-
-def get_status_text(is_still, is_centered):
-    movement_status = "STILL" if is_still else "MOVING"
-    centering_status = "Centered" if is_centered else "Not Centered"
-    return f"{movement_status}; {centering_status}"
-
-def get_status_color(is_still, is_centered):
-    if is_still and is_centered:
-        return (0, 255, 0)  # Green - "STILL; Centered"
-    if is_still and not is_centered:
-        return (0, 255, 255)  # Yellow - "STILL; Not Centered"
-    else:
-        return (0, 0, 255)  # Red - "MOVING; Not Centered"
-
-def convert_to_display_units(mm_value):
-    if measurement_unit == 'cm':
-        return mm_value / 10.0
-    return mm_value
-
-def get_unit_label():
-    return measurement_unit
-
-def main():
-    global center_pixel, is_center_set, pixels_per_mm, measurement_unit, last_movement_time
-
-    while True:  # Get user preference for measurement unit
-        unit_choice = input("Enter measurement unit ('mm' for millimeters or 'cm' for centimeters): ").lower().strip()
-        if unit_choice in ['mm', 'cm']:
-            measurement_unit = unit_choice
-            break
-        else:
-            print("Invalid choice. Please enter 'mm' or 'cm'.")
-
-    print(f"\nUsing {measurement_unit} for measurements.")
-
-    cap = cv2.VideoCapture(0)
-    if not cap.isOpened():
-        print("Error: Cannot open webcam.")
-        return
-
-    qr_detector = cv2.QRCodeDetector()
-
-    print('\n--- Motion Tracker Initialized (OpenCV Detector) ---')
-    print('Instructions:')
-    print('  - Point the camera at the printed QR code.')
-    print('  - Press "c" to set the current position as the center point.')
-    print('  - Press "q" to quit the application.')
-    print(f'  - QR code is considered "Still" after {STILL_TIME_THRESHOLD} seconds within {MOVEMENT_THRESHOLD_MM}mm')
-
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            print("Error: Can't receive frame. Exiting ...")
-            break
-
-        current_time = time.time()
+import threading
+
+from tracker_common import (
+    KNOWN_QR_WIDTH_MM, MOVEMENT_THRESHOLD_MM, STILL_TIME_THRESHOLD, DETECT_EVERY, ARROW_LENGTH,
+    ARROW_OFFSET, TARGET_QR_DATA, TrackerState, warm_up_kernels, calculate_displacement,
+    reset_position_history, update_position_history, is_qr_still, is_qr_centered, get_status,
+    convert_to_display_units, get_unit_label, draw_static_text, to_point, tracked_rois,
+    half_size_scan, DetectionPipeline, configure_camera, CaptureThread, Display,
+    run_until_stopped,
+)
+
+TRACKED_QR_DATA = (TARGET_QR_DATA,)  # QR codes each scan has to find
+
+def find_target_qr(state, decoded_info, points):
+    """Return the target QR code's corner points from a scan result, or None if it isn't visible.
+    The bbox is kept so the next scan only looks at the area around it."""
+    target_bboxes = [bbox for data, bbox in zip(decoded_info, points) if data == TARGET_QR_DATA]
+    state.last_bboxes.clear()  # A miss rescans the full frame
+    if not target_bboxes:
+        return None
+    state.last_bboxes[TARGET_QR_DATA] = target_bboxes[0]
+    return target_bboxes[0]
+
+def track(state, capture, display, detection, stop_event):
+    """Detect, measure and annotate each captured frame until the stop event is set"""
+    unit_label = get_unit_label(state)  # The unit is fixed once tracking starts
+    frame_seq = 0
+    frame_idx = 0
+    points = None
+    while not stop_event.is_set():
+        frame_seq, frame, current_time = capture.wait_for_frame(frame_seq)
+        if frame is None:
+            continue
+
+        center_point, center_set = state.center_pixel, state.is_center_set  # Local copies for the per-frame reads
         found_target_qr = False
         current_center_pixel = None
-        qr_data, bbox, _ = qr_detector.detectAndDecode(frame)
 
-        if bbox is not None and qr_data == TARGET_QR_DATA:
+        # Between detections the last known bbox is reused; a lost target is searched for every frame
+        # Detection of frame N runs in the worker while frame N+1 is drawn with the last finished result
+        result = detection.poll()
+        if result is not None:
+            decoded_info, scanned_points, _ = result
+            points = find_target_qr(state, decoded_info, scanned_points)
+        if not detection.busy and (frame_idx % DETECT_EVERY == 0 or points is None):
+            detection.submit(frame, tracked_rois(state, TRACKED_QR_DATA, frame.shape), half_size_scan(state))
+        frame_idx += 1
+
+        if points is not None:
             found_target_qr = True
             
-            points = bbox[0]
             pixel_width = np.linalg.norm(points[0] - points[1])
-            current_center_pixel = tuple(np.mean(points, axis=0).astype(int))
+            current_center_pixel = points.mean(axis=0)
 
             if pixel_width > 0:
-                pixels_per_mm = pixel_width / (KNOWN_QR_CODE_WIDTH_CM * 10)
+                state.pixels_per_mm = float(pixel_width) / KNOWN_QR_WIDTH_MM
+                state.pixel_to_mm = 1.0 / state.pixels_per_mm
 
-            update_position_history(current_center_pixel, current_time)  # Update position history for stillness tracking
+            update_position_history(state, current_center_pixel, current_time)  # Update position history for stillness tracking
 
             cv2.polylines(frame, [points.astype(int)], isClosed=True, color=(0, 255, 0), thickness=2)
-            cv2.circle(frame, current_center_pixel, 5, (0, 0, 255), -1)
+            cv2.circle(frame, to_point(current_center_pixel), 5, (0, 0, 255), -1)
 
-            if is_center_set:
-                total_dist_mm, dist_x_mm, dist_y_mm = calculate_displacement(current_center_pixel)
-                cv2.line(frame, center_pixel, current_center_pixel, (255, 0, 255), 2)
+            if center_set:
+                total_dist_mm, dist_x_mm, dist_y_mm, (unit_x, unit_y) = calculate_displacement(state, current_center_pixel)
+                cv2.line(frame, to_point(center_point), to_point(current_center_pixel), (255, 0, 255), 2)
 
                 if total_dist_mm > 0:
-                    dx = center_pixel[0] - current_center_pixel[0]
-                    dy = center_pixel[1] - current_center_pixel[1]
-                    
-                    magnitude = math.sqrt(dx**2 + dy**2)
-                    udx, udy = dx / magnitude, dy / magnitude
-
-                    arrow_length = 40
-                    offset_distance = 25
-                    perp_dx, perp_dy = -udy, udx
-
-                    start_point = (int(current_center_pixel[0] + perp_dx * offset_distance), 
-                                    int(current_center_pixel[1] + perp_dy * offset_distance))
-                    end_point = (int(start_point[0] + udx * arrow_length), 
-                                    int(start_point[1] + udy * arrow_length))
-
-                    cv2.arrowedLine(frame, start_point, end_point, (255, 255, 255), 2, tipLength=0.4)
-
-                dist_x_display = convert_to_display_units(dist_x_mm)
-                dist_y_display = convert_to_display_units(dist_y_mm)
-                total_dist_display = convert_to_display_units(total_dist_mm)
-                unit_label = get_unit_label()
+                    direction = np.array((-unit_x, -unit_y), np.float32)  # Arrow points back towards the center
+                    perp = np.array((-direction[1], direction[0]), np.float32)
+
+                    # Rows are the arrow's start and end: offset sideways from the target, then along direction
+                    arrow = current_center_pixel + perp * ARROW_OFFSET + np.float32((0, ARROW_LENGTH))[:, None] * direction
+
+                    cv2.arrowedLine(frame, to_point(arrow[0]), to_point(arrow[1]), (255, 255, 255), 2, tipLength=0.4)
+
+                dist_x_display = convert_to_display_units(state, dist_x_mm)
+                dist_y_display = convert_to_display_units(state, dist_y_mm)
+                total_dist_display = convert_to_display_units(state, total_dist_mm)
                 
                 info_text = f"X: {dist_x_display:.2f}{unit_label} | Y: {dist_y_display:.2f}{unit_label}"
                 total_dist_text = f"Total Disp: {total_dist_display:.2f}{unit_label}"
@@ -178,43 +87,93 @@ def main():
                 cv2.putText(frame, total_dist_text, (10, 90), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (180, 180, 0), 2)
 
                 # Determine status based on stillness and centering
-                is_still = is_qr_still(current_time)
+                is_still = is_qr_still(state, current_time)
                 is_centered = is_qr_centered(total_dist_mm)
                 
-                status_text = get_status_text(is_still, is_centered)
-                status_color = get_status_color(is_still, is_centered)
+                status_color, status_text = get_status(is_still, is_centered)
                 
-                cv2.putText(frame, f"Status: {status_text}", (10, 120), cv2.FONT_HERSHEY_SIMPLEX, 0.7, status_color, 2)
+                draw_static_text(state, frame, f"Status: {status_text}", (10, 120), 0.7, status_color, 2)
                 
-                time_since_movement = current_time - last_movement_time if last_movement_time else 0
+                time_since_movement = current_time - state.last_movement_time if state.last_movement_time else 0
                 debug_text = f"Still Time: {time_since_movement:.1f}s"
                 cv2.putText(frame, debug_text, (10, 150), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 0), 1)
 
-        if not is_center_set:
-            cv2.putText(frame, "Press 'c' to set center", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 255), 2)
+        if not center_set:
+            draw_static_text(state, frame, "Press 'c' to set center", (10, 30), 0.8, (0, 255, 255), 2)
         else:
-            cv2.putText(frame, "Center Set. Tracking...", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 180, 0), 2)
-            cv2.circle(frame, center_pixel, 7, (0, 255, 0), -1)
-            cv2.drawMarker(frame, center_pixel, (180, 180, 180), markerType=cv2.MARKER_CROSS, markerSize=15, thickness=2)
+            draw_static_text(state, frame, "Center Set. Tracking...", (10, 30), 0.8, (0, 180, 0), 2)
+            cv2.circle(frame, to_point(center_point), 7, (0, 255, 0), -1)
+            cv2.drawMarker(frame, to_point(center_point), (180, 180, 180), markerType=cv2.MARKER_CROSS, markerSize=15, thickness=2)
 
-        cv2.imshow('MRI Head Motion Tracker', frame)
+        display.show(frame)
 
-        key = cv2.waitKey(1) & 0xFF
-        if key == ord('q'):
-            print("'q' pressed. Exiting.")
-            break
-        elif key == ord('c'):
+        key = display.pop_key()
+        if key == ord('c'):
             if found_target_qr:
-                center_pixel = current_center_pixel
-                is_center_set = True
-                last_movement_time = time.time()
-                position_history.clear()
-                print(f"Center set at pixel coordinates: {center_pixel}")
+                state.center_pixel = current_center_pixel
+                state.is_center_set = True
+                state.last_movement_time = time.time()
+                reset_position_history(state)
+                print(f"Center set at pixel coordinates: {to_point(state.center_pixel)}")
             else:
                 print("Warning: Cannot set center. Target QR code not visible.")
 
-    cap.release()
-    cv2.destroyAllWindows()
+def main():
+    state = TrackerState()
+
+    while True:  # Get user preference for measurement unit
+        unit_choice = input("Enter measurement unit ('mm' for millimeters or 'cm' for centimeters): ").lower().strip()
+        if unit_choice in ['mm', 'cm']:
+            state.measurement_unit = unit_choice
+            break
+        else:
+            print("Invalid choice. Please enter 'mm' or 'cm'.")
+
+    print(f"\nUsing {state.measurement_unit} for measurements.")
+
+    warm_up_kernels()
+
+    cap = cv2.VideoCapture(0)
+    if not cap.isOpened():
+        print("Error: Cannot open webcam.")
+        return
+
+    configure_camera(cap)
+
+    ret, frame = cap.read()  # The detection buffer is sized from a real frame
+    if not ret:
+        print("Error: Can't receive frame. Exiting ...")
+        cap.release()
+        return
+
+    # Start the detection worker before any other thread exists
+    detection = DetectionPipeline(frame.shape[:2], TRACKED_QR_DATA)
+
+    print(f'\n--- Motion Tracker Initialized ({detection.detector_name}) ---')
+    print('Instructions:')
+    print('  - Point the camera at the printed QR code.')
+    print('  - Press "c" to set the current position as the center point.')
+    print('  - Press "q" to quit the application.')
+    print(f'  - QR code is considered "Still" after {STILL_TIME_THRESHOLD} seconds within {MOVEMENT_THRESHOLD_MM}mm')
+
+    stop_event = threading.Event()
+    capture = CaptureThread(cap, stop_event)
+    display = Display('MRI Head Motion Tracker', stop_event)
+    tracker = threading.Thread(target=run_until_stopped, daemon=True,
+                               args=(stop_event, track, state, capture, display, detection, stop_event))
+    try:
+        capture.start()
+        tracker.start()
+        display.run()  # HighGUI stays on the main thread; the tracking loop runs in tracker
+    finally:
+        # Also runs on an error or Ctrl+C, so the camera is always released
+        # and the shared memory segment is never left behind
+        stop_event.set()
+        for thread in (tracker, capture):
+            if thread.is_alive():
+                thread.join()
+        detection.close()
+        cap.release()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,64 @@
+#!/usr/bin/env bash
+# Build OpenCV 4.11 with opencv_contrib (for wechat_qrcode) and a SIMD baseline
+# above the SSE3 of the prebuilt pip wheels, then install its Python bindings
+# into the active interpreter.
+#
+# x86-64 (default):   AVX2 baseline, AVX-512 kernels dispatched at runtime
+# Apple Silicon/ARM:  NEON baseline, e.g.  CPU_BASELINE=NEON CPU_DISPATCH= ./requirements-fast.sh
+#                     (WITH_NEON is switched on automatically on ARM)
+#
+# Uninstall any pip opencv-python / opencv-contrib-python first; they would
+# shadow the bindings built here.
+set -euo pipefail
+
+OPENCV_VERSION="${OPENCV_VERSION:-4.11.0}"
+BUILD_DIR="${BUILD_DIR:-$(pwd)/opencv-build}"
+JOBS="${JOBS:-$(getconf _NPROCESSORS_ONLN)}"
+PYTHON="${PYTHON:-$(command -v python3)}"
+
+case "$(uname -m)" in
+    arm64|aarch64)
+        CPU_BASELINE="${CPU_BASELINE:-NEON}"
+        CPU_DISPATCH="${CPU_DISPATCH-}"
+        EXTRA_FLAGS=(-DWITH_NEON=ON)
+        ;;
+    *)
+        CPU_BASELINE="${CPU_BASELINE:-AVX2}"
+        CPU_DISPATCH="${CPU_DISPATCH-AVX512_SKX}"
+        EXTRA_FLAGS=()
+        ;;
+esac
+
+"$PYTHON" -m pip install numpy numba qrcode pillow
+
+mkdir -p "$BUILD_DIR"
+cd "$BUILD_DIR"
+for repo in opencv opencv_contrib; do
+    if [ ! -d "$repo" ]; then
+        git clone --depth 1 --branch "$OPENCV_VERSION" "https://github.com/opencv/$repo.git"
+    fi
+done
+
+cmake -S opencv -B build \
+    -DCMAKE_BUILD_TYPE=Release \
+    -DCMAKE_C_FLAGS_RELEASE="-O3 -DNDEBUG" \
+    -DCMAKE_CXX_FLAGS_RELEASE="-O3 -DNDEBUG" \
+    -DCPU_BASELINE="$CPU_BASELINE" \
+    -DCPU_DISPATCH="$CPU_DISPATCH" \
+    -DBUILD_opencv_objdetect=ON \
+    -DBUILD_opencv_wechat_qrcode=ON \
+    -DOPENCV_EXTRA_MODULES_PATH="$BUILD_DIR/opencv_contrib/modules" \
+    -DBUILD_opencv_python3=ON \
+    -DPYTHON3_EXECUTABLE="$PYTHON" \
+    -DOPENCV_PYTHON3_INSTALL_PATH="$("$PYTHON" -c 'import sysconfig; print(sysconfig.get_paths()["platlib"])')" \
+    -DBUILD_TESTS=OFF \
+    -DBUILD_PERF_TESTS=OFF \
+    -DBUILD_EXAMPLES=OFF \
+    -DBUILD_DOCS=OFF \
+    ${EXTRA_FLAGS[@]+"${EXTRA_FLAGS[@]}"}
+
+cmake --build build --parallel "$JOBS"
+cmake --install build  # May need sudo for the default /usr/local prefix
+
+# The Baseline line should list the instruction sets requested above
+"$PYTHON" -c "import cv2; print(cv2.__version__); print(cv2.getBuildInformation())" | grep -E "^[0-9]|Baseline|Dispatched"
@@ -0,0 +1,452 @@
+import cv2
+import numpy as np
+import math
+import os
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from dataclasses import dataclass, field
+from typing import Optional
+
+from numba import njit
+
+TARGET_WIDTH_INCHES = 1.5
+
+KNOWN_QR_CODE_WIDTH_CM = TARGET_WIDTH_INCHES * 2.54
+KNOWN_QR_WIDTH_MM = KNOWN_QR_CODE_WIDTH_CM * 10
+MOVEMENT_THRESHOLD_MM = 2.5
+STILL_TIME_THRESHOLD = 1.0
+HISTORY_SIZE = 100
+HISTORY_WINDOW_S = 3.0
+RECENT_WINDOW_S = 0.5
+CAMERA_WIDTH = 1280
+CAMERA_HEIGHT = 720
+CAMERA_FPS = 30
+DETECTION_SCALE = 2  # Scans of large codes first try a cv2.pyrDown'd (half-size) image
+HALF_SIZE_MIN_WIDTH = 240  # Narrower codes (full-resolution px) are often lost by the half-size scan
+ROI_PADDING = 0.5  # ROI margin around the last bbox, as a fraction of its size
+DETECT_EVERY = 2  # Run the detector on every Nth frame while the QR codes stay in view
+ARROW_LENGTH = 40
+ARROW_OFFSET = 25  # Perpendicular offset of the direction arrow from the target center
+TARGET_QR_DATA = "MRI_HEAD_MOTION_TRACKER_V1.0"
+
+# Optional WeChat CNN models (detect/sr .prototxt and .caffemodel), not shipped with the repo
+WECHAT_MODEL_URL = "https://github.com/WeChatCV/opencv_3rdparty"
+WECHAT_MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "wechat_models")
+WECHAT_MODEL_FILES = ("detect.prototxt", "detect.caffemodel", "sr.prototxt", "sr.caffemodel")
+
+@dataclass(slots=True)
+class TrackerState:
+    """Calibration, stillness history and caches passed to the per-frame functions"""
+    center_pixel: Optional[np.ndarray] = None
+    is_center_set: bool = False
+    pixels_per_mm: Optional[float] = None
+    pixel_to_mm: Optional[float] = None  # Cached 1 / pixels_per_mm
+    measurement_unit: str = 'mm'  # Default to millimeters
+
+    # Ring buffer of recent positions with timestamps (float64 keeps sub-ms precision on epoch seconds)
+    # Positions stay float32: Numba has no float16, and casting a float16 buffer on every update costs more than it saves
+    history_positions: np.ndarray = field(default_factory=lambda: np.empty((HISTORY_SIZE, 2), np.float32))
+    history_times: np.ndarray = field(default_factory=lambda: np.empty(HISTORY_SIZE, np.float64))
+    history_head: int = 0  # Next slot to write
+    history_count: int = 0
+    last_movement_time: Optional[float] = None
+    last_bboxes: dict = field(default_factory=dict)  # Bbox per QR label from the previous frame, gates detection to an ROI
+    text_overlays: dict = field(default_factory=dict)  # Pre-rendered masks and color patches for draw_static_text
+
+@njit(cache=True)
+def _displacement_kernel(x, y, center_x, center_y, pixel_to_mm):
+    delta_x_pix = x - center_x
+    delta_y_pix = y - center_y
+    pixel_distance = math.sqrt(delta_x_pix * delta_x_pix + delta_y_pix * delta_y_pix)
+
+    unit_x = 0.0
+    unit_y = 0.0
+    if pixel_distance > 0:
+        unit_x = delta_x_pix / pixel_distance
+        unit_y = delta_y_pix / pixel_distance
+
+    return pixel_distance * pixel_to_mm, delta_x_pix * pixel_to_mm, delta_y_pix * pixel_to_mm, unit_x, unit_y
+
+@njit(cache=True)
+def _ring_search(times, head, count, cutoff):
+    """Binary search the ring's monotonic timestamps, oldest first,
+    for the number of entries older than cutoff"""
+    size = times.shape[0]
+    lo = 0
+    hi = count
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if times[(head - count + mid) % size] < cutoff:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+@njit(cache=True)
+def _history_kernel(positions, times, head, count, x, y, current_time, pixel_to_mm, recent_window, history_window):
+    """Push a position into the ring buffer and return (head, count, moved). moved is set for the first
+    position and whenever it is over MOVEMENT_THRESHOLD_MM from the recent mean; pixel_to_mm is 0 while uncalibrated."""
+    size = times.shape[0]
+    moved = count == 0
+    sum_x = 0.0
+    sum_y = 0.0
+    first_recent = _ring_search(times, head, count, current_time - recent_window)
+    recent = count - first_recent
+    for k in range(first_recent, count):
+        i = (head - count + k) % size
+        sum_x += positions[i, 0]
+        sum_y += positions[i, 1]
+
+    if recent > 0:
+        distance_pixels = math.hypot(x - sum_x / recent, y - sum_y / recent)
+        moved = moved or distance_pixels * pixel_to_mm > MOVEMENT_THRESHOLD_MM
+
+    positions[head, 0] = x
+    positions[head, 1] = y
+    times[head] = current_time
+    head = (head + 1) % size
+    count = min(count + 1, size)
+
+    # Timestamps are monotonic, so the stale entries are the oldest ones
+    count -= _ring_search(times, head, count, current_time - history_window)
+
+    return head, count, moved
+
+def warm_up_kernels():
+    """Compile the Numba kernels up front so the first tracked frame doesn't stall"""
+    _displacement_kernel(1.0, 1.0, 0.0, 0.0, 1.0)
+    _history_kernel(np.empty((HISTORY_SIZE, 2), np.float32), np.empty(HISTORY_SIZE, np.float64), 0, 0,
+                    0.0, 0.0, 0.0, 0.0, RECENT_WINDOW_S, HISTORY_WINDOW_S)
+
+def calculate_displacement(state, current_center_pixel):
+    """Return the displacement of a (2,) float32 pixel position from the center in mm,
+    and the unit vector of its direction"""
+    if not state.is_center_set or state.pixel_to_mm is None:
+        return 0, 0, 0, (0.0, 0.0)
+
+    x, y = current_center_pixel.tolist()
+    center_x, center_y = state.center_pixel.tolist()
+    mm_distance, delta_x_mm, delta_y_mm, unit_x, unit_y = _displacement_kernel(x, y, center_x, center_y, state.pixel_to_mm)
+
+    return mm_distance, delta_x_mm, delta_y_mm, (unit_x, unit_y)
+
+def reset_position_history(state):
+    state.history_head = 0
+    state.history_count = 0
+
+def update_position_history(state, current_center_pixel, current_time):
+    """Update position history for tracking stillness, given a (2,) float32 pixel position"""
+    x, y = current_center_pixel.tolist()
+    state.history_head, state.history_count, moved = _history_kernel(
+        state.history_positions, state.history_times, state.history_head, state.history_count,
+        x, y, current_time, state.pixel_to_mm or 0.0, RECENT_WINDOW_S, HISTORY_WINDOW_S)
+
+    if moved:
+        state.last_movement_time = current_time
+
+def is_qr_still(state, current_time):
+    if state.last_movement_time is None:
+        return False
+    return (current_time - state.last_movement_time) >= STILL_TIME_THRESHOLD
+
+def is_qr_centered(total_distance_mm):
+    return total_distance_mm <= MOVEMENT_THRESHOLD_MM
+
+# (color, text) indexed by (is_still << 1) | is_centered
+STATUS_LOOKUP = (
+    ((0, 0, 255), "MOVING; Not Centered"),  # Red
+    ((0, 0, 255), "MOVING; Centered"),  # Red
+    ((0, 255, 255), "STILL; Not Centered"),  # Yellow
+    ((0, 255, 0), "STILL; Centered"),  # Green
+)
+
+def get_status(is_still, is_centered):
+    """Return the (color, text) of the tracking status"""
+    return STATUS_LOOKUP[(is_still << 1) | is_centered]
+
+def convert_to_display_units(state, mm_value):
+    if state.measurement_unit == 'cm':
+        return mm_value / 10.0
+    return mm_value
+
+def get_unit_label(state):
+    return state.measurement_unit
+
+def draw_static_text(state, frame, text, org, font_scale, color, thickness):
+    """cv2.putText for labels that repeat across frames: the glyphs are rasterized once into a
+    cached mask and color patch, and each frame blits the patch through the mask"""
+    key = (text, org, font_scale, color, thickness)
+    overlay = state.text_overlays.get(key)
+    if overlay is None:
+        (width, height), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, font_scale, thickness)
+        x0, y0 = max(org[0] - thickness, 0), max(org[1] - height - thickness, 0)
+        mask = np.zeros((org[1] + baseline + thickness - y0, org[0] + width + thickness - x0), np.uint8)
+        cv2.putText(mask, text, (org[0] - x0, org[1] - y0), cv2.FONT_HERSHEY_SIMPLEX, font_scale, 255, thickness)
+        patch = np.empty(mask.shape + (3,), np.uint8)
+        patch[:] = color
+        overlay = state.text_overlays[key] = (x0, y0, mask, patch)
+
+    x0, y0, mask, patch = overlay
+    region = frame[y0:y0 + mask.shape[0], x0:x0 + mask.shape[1]]
+    height, width = region.shape[:2]
+    cv2.copyTo(patch[:height, :width], mask[:height, :width], region)  # Writes into the frame through the view
+
+def half_size_scan(state):
+    """Whether a scan may try a half-size image first, judged by the last known code width"""
+    # Always detecting on a pyrDown'd frame was mostly declined: at the working distance the codes are
+    # about 90-160 px wide, where half-size scans lose most of them. Only wider codes try it first.
+    return state.pixels_per_mm is not None and state.pixels_per_mm * KNOWN_QR_WIDTH_MM >= HALF_SIZE_MIN_WIDTH
+
+def to_point(pixel):
+    """Integer (x, y) tuple of a pixel position, for the OpenCV drawing calls"""
+    return tuple(pixel.astype(int).tolist())
+
+def detection_roi(bbox, frame_shape):
+    """Return (x0, y0, x1, y1) around a (4, 2) bbox, dilated by ROI_PADDING times its size"""
+    low = bbox.min(axis=0)
+    high = bbox.max(axis=0)
+    padding = (high - low).max() * ROI_PADDING
+    low = low - padding
+    high = high + padding
+
+    height, width = frame_shape[:2]
+    x0, y0 = max(int(low[0]), 0), max(int(low[1]), 0)
+    x1, y1 = min(int(np.ceil(high[0])), width), min(int(np.ceil(high[1])), height)
+    return x0, y0, x1, y1
+
+def tracked_rois(state, labels, frame_shape):
+    """One ROI per label around its last bbox, or None to scan the full frame.
+    The ROIs are only used while every label is tracked and they are smaller than the frame."""
+    if not all(label in state.last_bboxes for label in labels):
+        return None
+
+    rois = [detection_roi(state.last_bboxes[label], frame_shape) for label in labels]
+    if sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in rois) >= frame_shape[0] * frame_shape[1]:
+        return None  # Codes this close to the camera are cheaper to find in one full-frame scan
+    return rois
+
+def create_qr_detector():
+    """Return (detector, name) for the best QR detector available: WeChat's with its CNN detector and
+    super-resolution models in WECHAT_MODEL_DIR, then OpenCV's ArUco-based detector (OpenCV 4.8+),
+    then WeChat's traditional localizer, else OpenCV's stock detector"""
+    has_wechat = hasattr(cv2, 'wechat_qrcode_WeChatQRCode')
+    if has_wechat:
+        model_paths = [os.path.join(WECHAT_MODEL_DIR, name) for name in WECHAT_MODEL_FILES]
+        if all(os.path.isfile(path) for path in model_paths):
+            return cv2.wechat_qrcode_WeChatQRCode(*model_paths), "WeChat QR, CNN models"
+        print(f"Warning: WeChat CNN models not found. To use them, download "
+              f"{', '.join(WECHAT_MODEL_FILES)} from {WECHAT_MODEL_URL} into {WECHAT_MODEL_DIR}")
+
+    if hasattr(cv2, 'QRCodeDetectorAruco'):
+        # A wider adaptive threshold window (default 23) finds more of the small, full-resolution codes
+        qr_detector = cv2.QRCodeDetectorAruco()
+        aruco_params = qr_detector.getArucoParameters()
+        aruco_params.adaptiveThreshWinSizeMax = 33
+        qr_detector.setArucoParameters(aruco_params)
+        return qr_detector, "OpenCV QRCodeDetectorAruco"
+
+    if has_wechat:
+        return cv2.wechat_qrcode_WeChatQRCode(), "WeChat QR, traditional localizer"
+    return cv2.QRCodeDetector(), "OpenCV QRCodeDetector"
+
+def decode_qr_codes(image, qr_detector):
+    """Detect and decode all QR codes in the image, returning (decoded_info, points) with points shaped (N, 4, 2)"""
+    if hasattr(qr_detector, 'detectAndDecodeMulti'):
+        success, decoded_info, points, _ = qr_detector.detectAndDecodeMulti(image)
+        if not success:
+            return (), np.empty((0, 4, 2), np.float32)
+        return decoded_info, points
+
+    decoded_info, points = qr_detector.detectAndDecode(image)  # WeChatQRCode
+    return decoded_info, np.asarray(points, np.float32).reshape(-1, 4, 2)
+
+def _scan_rois(gray, qr_detector, rois, scale):
+    """Decode the codes in each (x0, y0, x1, y1) ROI, downscaled by scale (1 or DETECTION_SCALE)"""
+    decoded_info, points = [], []
+    for x0, y0, x1, y1 in rois:
+        image = gray[y0:y1, x0:x1]
+        roi_info, roi_points = decode_qr_codes(image if scale == 1 else cv2.pyrDown(image), qr_detector)
+        for data, bbox in zip(roi_info, roi_points):
+            if data and data not in decoded_info:  # Neighbouring ROIs can both contain a code
+                decoded_info.append(data)
+                points.append(bbox * scale + (x0, y0))
+    return decoded_info, np.array(points, np.float32).reshape(-1, 4, 2)
+
+def scan_qr_codes(gray, qr_detector, rois, labels, half_size):
+    """Decode the QR codes in a grayscale frame, scanning only the (x0, y0, x1, y1) rois if given.
+    With half_size, the scan tries half-size images first and only rescans at full resolution
+    if that misses any of labels. Points are returned in frame coordinates."""
+    if rois is None:
+        rois = [(0, 0, gray.shape[1], gray.shape[0])]
+
+    for scale in (DETECTION_SCALE, 1) if half_size else (1,):
+        decoded_info, points = _scan_rois(gray, qr_detector, rois, scale)
+        if set(labels) <= set(decoded_info):
+            break
+    return decoded_info, points
+
+# Detector and shared frame of the detection worker process
+_worker_detector = None
+_worker_detector_name = None
+_worker_shm = None
+_worker_gray = None
+_worker_labels = ()
+
+def _init_detect_worker(shm_name, frame_shape, labels):
+    global _worker_detector, _worker_detector_name, _worker_shm, _worker_gray, _worker_labels
+    _worker_shm = shared_memory.SharedMemory(name=shm_name)
+    _worker_gray = np.ndarray(frame_shape, np.uint8, buffer=_worker_shm.buf)
+    _worker_detector, _worker_detector_name = create_qr_detector()
+    _worker_labels = labels
+
+def _worker_detector_info():
+    return _worker_detector_name
+
+def detect_worker(rois, half_size):
+    """Scan the frame currently in shared memory; runs in the detection process"""
+    decoded_info, points = scan_qr_codes(_worker_gray, _worker_detector, rois, _worker_labels, half_size)
+    return decoded_info, points, rois
+
+class DetectionPipeline:
+    """Runs QR detection in a worker process on grayscale frames passed through shared memory,
+    so the main process keeps drawing while the detector works. labels are the QR codes the tracker
+    needs; a half-size scan that misses one of them is redone at full resolution."""
+
+    def __init__(self, frame_shape, labels):
+        self._shm = shared_memory.SharedMemory(create=True, size=int(np.prod(frame_shape)))
+        self._gray = np.ndarray(frame_shape, np.uint8, buffer=self._shm.buf)
+
+        # Never fork the threaded main process: the worker comes from a forkserver (spawn on Windows)
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        self._pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context(start_method),
+                                         initializer=_init_detect_worker, initargs=(self._shm.name, frame_shape, tuple(labels)))
+        # Starts the worker and loads its detector up front
+        self.detector_name = self._pool.submit(_worker_detector_info).result()
+        self._future = None
+
+    @property
+    def busy(self):
+        return self._future is not None
+
+    def submit(self, frame, rois, half_size):
+        """Convert the BGR frame to grayscale straight into shared memory and start scanning it"""
+        # Stays on the CPU rather than a cv2.UMat: the worker reads the frame from host memory
+        cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self._gray)  # The detector works on one channel
+        self._future = self._pool.submit(detect_worker, rois, half_size)
+
+    def poll(self):
+        """Return (decoded_info, points, rois) once the pending scan is done, else None"""
+        if self._future is None or not self._future.done():
+            return None
+        result = self._future.result()
+        self._future = None
+        return result
+
+    def close(self):
+        self._pool.shutdown(wait=True, cancel_futures=True)
+        self._gray = None  # Release the buffer view before closing the mapping
+        self._shm.close()
+        self._shm.unlink()
+
+def configure_camera(cap):
+    """Request an MJPG stream with a one-frame buffer so cap.read() returns the freshest frame"""
+    cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))  # Must be set before the resolution on V4L2
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, CAMERA_WIDTH)
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, CAMERA_HEIGHT)
+    cap.set(cv2.CAP_PROP_FPS, CAMERA_FPS)
+
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    print(f"Camera: {cap.getBackendName()} backend, {width}x{height} @ {cap.get(cv2.CAP_PROP_FPS):.0f} fps")
+
+class CaptureThread(threading.Thread):
+    """Reads frames from the camera, keeping only the most recent one"""
+
+    def __init__(self, cap, stop_event):
+        super().__init__(daemon=True)
+        self._cap = cap
+        self._stop_event = stop_event
+        self._new_frame = threading.Condition(threading.Lock())
+        self._latest = None
+        self._latest_time = None
+        self._seq = 0
+
+    def run(self):
+        while not self._stop_event.is_set():
+            ret, frame = self._cap.read()
+            if not ret:
+                print("Error: Can't receive frame. Exiting ...")
+                self._stop_event.set()
+                break
+
+            capture_time = time.time()
+            with self._new_frame:
+                self._latest = frame  # Overwrite, older frames are dropped
+                self._latest_time = capture_time
+                self._seq += 1
+                self._new_frame.notify()
+
+    def wait_for_frame(self, last_seq, timeout=0.1):
+        """Return (seq, frame, capture_time) for the newest frame after last_seq, or a None frame on timeout"""
+        with self._new_frame:
+            if self._seq == last_seq:
+                self._new_frame.wait(timeout)
+            if self._seq == last_seq:
+                return last_seq, None, None
+            return self._seq, self._latest, self._latest_time
+
+def run_until_stopped(stop_event, target, *args):
+    """Call target(*args) and set the stop event when it returns or raises, so the other threads end too"""
+    try:
+        target(*args)
+    finally:
+        stop_event.set()
+
+class Display:
+    """Shows the latest annotated frame and polls the keyboard.
+    run() must be called from the main thread: macOS HighGUI only works there."""
+
+    def __init__(self, window_name, stop_event):
+        self._window_name = window_name
+        self._stop_event = stop_event
+        self._lock = threading.Lock()
+        self._frame = None
+        self._key = None
+
+    def show(self, frame):
+        with self._lock:
+            self._frame = frame
+
+    def pop_key(self):
+        """Return the last key pressed since the previous call, or None"""
+        with self._lock:
+            key, self._key = self._key, None
+        return key
+
+    def run(self):
+        """Show frames until 'q' is pressed or the stop event is set"""
+        window_open = False
+        while not self._stop_event.is_set():
+            with self._lock:
+                frame, self._frame = self._frame, None
+
+            if frame is not None:
+                cv2.imshow(self._window_name, frame)
+                window_open = True
+            elif not window_open:
+                self._stop_event.wait(0.005)  # waitKey returns immediately without a window
+                continue
+
+            key = cv2.waitKey(1) & 0xFF
+            if key == ord('q'):
+                print("'q' pressed. Exiting.")
+                self._stop_event.set()
+            elif key != 0xFF:
+                with self._lock:
+                    self._key = key
+
+        cv2.destroyAllWindows()